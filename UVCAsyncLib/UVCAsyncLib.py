@@ -1,20 +1,56 @@
 import asyncio
 from collections import namedtuple
+from datetime import datetime, timezone
+from functools import lru_cache
 from pathlib import Path
 from pprint import pprint
 import sys
-from time import sleep, strftime, gmtime
 
 from aiohttp import ClientSession, TCPConnector, request
-import click
-from pypeln import asyncio_task as aio
+from aiohttp.resolver import AsyncResolver, ThreadedResolver
+import aiofiles
+import httpx
+import orjson
+from tqdm.asyncio import tqdm as atqdm
+
+CameraInformation = namedtuple('CameraInformation',
+                               ['camera_id', 'camera_name', 'camera_addr', 'last_rec_id', 'last_rec_start_time_epoch',
+                                'rtsp_uri', 'rtsp_enabled'])
+
+ClipInformation = namedtuple('ClipInformation',
+                             ['clip_id', 'startTime', 'endTime', 'eventType', 'inProgress', 'locked',
+                              'cameraName', 'recordingPathId', 'fullFileName'])
+
+
+@lru_cache(maxsize=None)
+def _normalize_camera_name(camera_name):
+    """
+    Camera name as used in clip file names, e.g. 'Front Door' -> 'front_door'
+    """
+    return camera_name.replace(' ', '_').lower()
+
+
+def _camera_dir(output_path, camera_name):
+    """
+    Folder a camera's clips are saved in, e.g. 'Front Door' -> output_path/Front_Door
+    """
+    return Path(output_path, camera_name.replace(' ', '_'))
+
+class MetaDataError(Exception):
+    """
+    Raised when the meta data for a clip can't be obtained
+    """
 
 class UVC_API_Async(object):
     """
     Class of functions for talking to the UVC device
     """
 
-    def __init__(self, uvc_server, uvc_https_port, usrname, passwd, logger, ssl_verify=False, proxy=None, sleep_time=0.2, chunk_size=1024, max_connections=25):
+    # Cookies the web UI sends with every request, set once on the session after login
+    _SESSION_COOKIES = {'cameras.isManagedFilterOn': 'false', 'lastMap': 'null', 'lastLiveView': 'null'}
+    _SEARCH_HEADERS = {'content-type': 'application/x-www-form-urlencoded'}
+
+    def __init__(self, uvc_server, uvc_https_port, usrname, passwd, logger, ssl_verify=False, proxy=None, chunk_size=1048576, max_connections=25, max_meta_requests=32, async_dns=False):
         self.uvc_server = uvc_server
         self.uvc_https_port = uvc_https_port
         self.usrname = usrname
@@ -28,13 +64,23 @@ class UVC_API_Async(object):
         self.camera_mgrd_filter_value = False
         self.apiKey = None
         self.camera_info_dict = dict()
+        self.camera_name_dict = dict()
         self.dict_info_clip = dict()
-        self.sleep_time = sleep_time
+        # HTTP/2 client for the clip metadata requests, only open while clip_meta_data runs
+        self.h2_session = None
         self.chunk_size = chunk_size
         self.max_connections = max_connections
+        # Metadata requests are small and multiplexed, so they get their own limit instead of the download worker count
+        self.max_meta_requests = max_meta_requests
         
-        # Pypeln will take care of rate limiting, not AIOHttp
-        connector = TCPConnector(limit=0, ttl_dns_cache=300, verify_ssl=self.ssl_verify)
+        # Cap the pool at max_connections and keep idle connections warm so TLS sessions are reused.
+        # The system resolver goes through NSS, so mDNS names like uvc-controller.local resolve.
+        # c-ares (aiodns) is opt-in, aiohttp would otherwise pick it whenever aiodns is installed.
+        resolver = AsyncResolver() if async_dns else ThreadedResolver()
+        connector = TCPConnector(limit=self.max_connections, limit_per_host=self.max_connections,
+                                 resolver=resolver, use_dns_cache=True, ttl_dns_cache=3600,
+                                 keepalive_timeout=75, enable_cleanup_closed=True, ssl=self.ssl_verify)
+        # trust_env picks up HTTP(S)_PROXY from the environment, the CLI's only way to use a proxy
         self.session = ClientSession(connector=connector, trust_env=True, headers= {'User-Agent': 'UVCAsyncLib'})
 
         # Build the session
@@ -51,150 +97,188 @@ class UVC_API_Async(object):
         # Logs into UVC host
         login_payload = {'username': self.usrname, 'password': self.passwd}
 
-        r = await self.session.post(f"{self.url}/api/2.0/login", json=login_payload)
-        
-        if r.status is not 200:
-            data = await r.json()
-            self.logger.critical(f"Failed to log into the DVR. Check the error {data}")
-            sys.exit(1)
-        elif r.status is 200:
+        async with self.session.post(f"{self.url}/api/2.0/login", json=login_payload) as r:
+            if r.status != 200:
+                data = orjson.loads(await r.read())
+                self.logger.critical(f"Failed to log into the DVR. Check the error {data}")
+                sys.exit(1)
+
             self.logger.info("Successfully logged into the DVR")
-            
+            self.session.cookie_jar.update_cookies(self._SESSION_COOKIES)
+
             # Request all the user's data
             # user_resp = await self.session.get(f"{self.url}/api/2.0/user")
             # user_data = await user_resp.json()
-            user_data = await r.json()
-            self.logger.debug("Obtained all user config data")
-            # Get API token for the user
-            for d in user_data['data']:
-                if d['account']['username'] == self.usrname:
-                    self.apiKey = d['apiKey']
-                    self.logger.debug(f"Obtained {self.usrname}'s API key successfully")
+            user_data = orjson.loads(await r.read())
+        self.logger.debug("Obtained all user config data")
+        # Get API token for the user, stop at the first match
+        self.apiKey = next((d['apiKey'] for d in user_data['data'] if d['account']['username'] == self.usrname), None)
+        if self.apiKey is None:
+            self.logger.error(f"Couldn't find an API key for {self.usrname}.")
+            sys.exit(1)
+        self.logger.debug(f"Obtained {self.usrname}'s API key successfully")
         return r
     
     async def logout(self):
         # Logs out of UVC host
 
-        r = await self.session.get(f"{self.url}/api/2.0/logout")
-        if r.status is not 200:
-            error_text = await r.text
-            self.logger.critical(f"Failed to log out of the DVR. Check the error {error_text}")
-            sys.exit(1)
+        async with self.session.get(f"{self.url}/api/2.0/logout") as r:
+            if r.status != 200:
+                error_text = await r.text()
+                self.logger.critical(f"Failed to log out of the DVR. Check the error {error_text}")
+                sys.exit(1)
 
-        elif r.status is 200:
-            self.logger.info("Successfully logged out the DVR")
+        self.logger.info("Successfully logged out the DVR")
+        return r
 
-            return r
+    async def close(self):
+        """
+        Close both HTTP clients
+        """
+        await self._close_h2_session()
+        await self.session.close()
+
+    def _open_h2_session(self):
+        """
+        Open the HTTP/2 client for the metadata requests with the aiohttp session's current cookies
+        """
+        # The metadata phase is many small GETs, multiplex them over one HTTP/2 connection
+        # Match the aiohttp session's timeout and proxy handling so both HTTP stacks behave the same
+        self.h2_session = httpx.AsyncClient(http2=True, base_url=self.url, verify=self.ssl_verify,
+                                            timeout=httpx.Timeout(self.session.timeout.total),
+                                            trust_env=self.session.trust_env,
+                                            headers=dict(self.session.headers),
+                                            cookies={c.key: c.value for c in self.session.cookie_jar},
+                                            limits=httpx.Limits(max_connections=self.max_meta_requests, max_keepalive_connections=self.max_meta_requests))
+
+    async def _close_h2_session(self):
+        if self.h2_session is not None:
+            await self.h2_session.aclose()
+            self.h2_session = None
     
     async def camera_info(self):
         """
         Obtain information about the cameras. This is the bootstrap page
         """
-        camera_info = namedtuple('CameraInformation',
-                                 ['camera_id', 'camera_name', 'camera_addr', 'last_rec_id', 'last_rec_start_time_epoch',
-                                  'rtsp_uri', 'rtsp_enabled'])
-
-        r = await self.session.get(f"{self.url}/api/2.0/bootstrap", cookies={'cameras.isManagedFilterOn': 'false'})
-        if r.status is not 200:
-            error_text = await r.text
-            self.logger.critical(f'Failed to obtain the camera data. Check the error {error_text}')
-            sys.exit(1)
-        elif r.status is 200:
+        async with self.session.get(f"{self.url}/api/2.0/bootstrap") as r:
+            if r.status != 200:
+                error_text = await r.text()
+                self.logger.critical(f'Failed to obtain the camera data. Check the error {error_text}')
+                sys.exit(1)
             self.logger.debug("Obtained the bootstrap page.")
 
-        bootstrap_data = await r.json()
+            # Read the whole body before the connection goes back to the pool
+            body = await r.read()
+
+        try:
+            bootstrap_data = orjson.loads(body)
+        except orjson.JSONDecodeError as e:
+            self.logger.critical(f'The bootstrap page isn\'t valid JSON: {e}. Exiting.')
+            sys.exit(1)
 
         # Check if anything weird is going on with the bootstrap data
         try:
-            bootstrap_data['data'][0]['cameras']
+            cameras = bootstrap_data['data'][0]['cameras']
         except KeyError:
             self.logger.error('The UVC didn\'t provide the bootstrap data for the cameras.')
             pprint(bootstrap_data['data'])
             sys.exit(1)
-        else:
-            # Check if we got all of the data from bootstrap
-            if len(bootstrap_data['data'][0]['cameras']) > 0:
-                self.logger.info('Obtained camera data from bootstrap endpoint')
-            else:
-                self.logger.critical('The bootstrap endpoint didn\'t provide the correct data. Exiting.')
-                sys.exit(1)
 
-            for c in bootstrap_data['data'][0]['cameras']:
-                camera_id = c['_id']
-                camera_name = c['deviceSettings']['name']
-                camera_addr = c['host']
-                last_rec_id = c['lastRecordingId']
-                last_rec_start_time_epoch = c['lastRecordingStartTime']
-                for bitrate in c['channels']:
-                    if bitrate['id'] == '1':
-                        rtsp_uri = bitrate['rtspUris'][1]
-                        rtsp_enabled = bitrate['isRtspEnabled']
-                self.camera_info_dict.update({camera_id: camera_info(camera_id, camera_name, camera_addr, last_rec_id, last_rec_start_time_epoch, rtsp_uri, rtsp_enabled)})
+        for c in cameras:
+            camera_id = c['_id']
+            camera_name = c['deviceSettings']['name']
+            camera_addr = c['host']
+            last_rec_id = c['lastRecordingId']
+            last_rec_start_time_epoch = c['lastRecordingStartTime']
+            for bitrate in c['channels']:
+                if bitrate['id'] == '1':
+                    rtsp_uri = bitrate['rtspUris'][1]
+                    rtsp_enabled = bitrate['isRtspEnabled']
+            self.camera_info_dict.update({camera_id: CameraInformation(camera_id, camera_name, camera_addr, last_rec_id, last_rec_start_time_epoch, rtsp_uri, rtsp_enabled)})
+
+        # Reverse index so camera names can be looked up directly, names aren't unique so keep every ID
+        self.camera_name_dict = dict()
+        for cid, ci in self.camera_info_dict.items():
+            self.camera_name_dict.setdefault(ci.camera_name, list()).append(cid)
+
+        # Check if we got all of the data from bootstrap
+        if len(self.camera_info_dict) > 0:
+            self.logger.info('Obtained camera data from bootstrap endpoint')
+        else:
+            self.logger.critical('The bootstrap endpoint didn\'t provide the correct data. Exiting.')
+            sys.exit(1)
     
+    async def _fetch_meta(self, clip_id, semaphore):
+        """
+        Request the meta data for a single clip ID
+        """
+        async with semaphore:
+            try:
+                r = await self.h2_session.get(f"/api/2.0/recording/{clip_id}")
+            except httpx.HTTPError as e:
+                raise MetaDataError(f'Failed to request meta data for clip {clip_id}: {e!r}.') from e
+
+            if r.status_code == 401:
+                raise MetaDataError('Unauthorized.')
+            elif r.status_code != 200:
+                raise MetaDataError(f'Unexpected error occured for clip {clip_id}: {r.status_code}.')
+
+            # We grabbed clip meta data, continue.
+            # self.logger.debug(f'Meta data obtained for clip {clip_id}.')
+            try:
+                return orjson.loads(r.content)
+            except orjson.JSONDecodeError as e:
+                raise MetaDataError(f'The meta data for clip {clip_id} isn\'t valid JSON: {e}.') from e
+
     async def clip_meta_data(self, clip_id_list):
         """
         Get the meta data for each clip ID
-        - Check if
         """
-        meta_cookies = {'lastMap': 'null', 'lastLiveView': 'null'}
-        # meta_cookies.update(self.session.cookies)
-        camera_meta_data_list = list()
-        clip_id_list_len = len(clip_id_list)
         # url_id_params = str()
-        clip_info = namedtuple('ClipInformation',
-                                     ['clip_id', 'startTime', 'endTime', 'eventType', 'inProgress', 'locked',
-                                      'cameraName', 'recordingPathId', 'fullFileName'])
-
-        # Loop over the list and request data for each clip
-        with click.progressbar(clip_id_list, length=clip_id_list_len, label='Clip Data Downloaded', show_eta=False, show_percent=False, show_pos=True) as bar:
-            for id in bar:
-                # Prepare the search data
-                async with self.session.request('GET', f"{self.url}/api/2.0/recording/{id}", cookies=meta_cookies) as r:
-
-                    if r.status is 200:
-                        # We grabbed clip meta data, continue.
-                        # self.logger.debug(f'Meta data obtained for clip {id}.')
-                        json_data = await r.json()
-                        camera_meta_data_list.append(json_data)
-                        await asyncio.sleep(self.sleep_time)
-                    elif r.status is 401:
-                        self.logger.critical(f'Unauthorized, exiting.')
-                        sys.exit(1)
-                    else:
-                        self.logger.critical(f'Unexpected error occured: {r.status}. Exiting.')
-                        sys.exit(1)
-
-        for c in camera_meta_data_list:
+
+        # Open the HTTP/2 client now so it carries the session's current cookies
+        self._open_h2_session()
+        try:
+            # Request every clip's meta data at once, bounded to max_meta_requests in flight
+            semaphore = asyncio.Semaphore(self.max_meta_requests)
+            meta_tasks = [asyncio.ensure_future(self._fetch_meta(clip_id, semaphore)) for clip_id in clip_id_list]
+            try:
+                for fut in atqdm.as_completed(meta_tasks, total=len(meta_tasks), desc='Clip Data Downloaded'):
+                    await fut
+            except MetaDataError as e:
+                # Stop the other requests and wait for them to wind down before exiting
+                for task in meta_tasks:
+                    task.cancel()
+                await asyncio.gather(*meta_tasks, return_exceptions=True)
+                self.logger.critical(f'{e} Exiting.')
+                sys.exit(1)
+        finally:
+            await self._close_h2_session()
+
+        # Walk the tasks in the server's sort order, as_completed yields them in completion order
+        for task in meta_tasks:
+            c = task.result()['data'][0]
             # Skip clips that are in progress of recording
-            c = c['data'][0]
             if c['inProgress']:
                 self.logger.warning(f"Skipping clip ID {c['_id']}, it\'s still recording")
-            else:
-                # Clips that are done recording
-                clip_id = c['_id']
-                startTime = c['startTime']
-                endTime = c['endTime']
-                eventType = c['eventType']
-                inProgress = c['inProgress']
-                locked = c['locked']
-                cameraName = c['meta']['cameraName']
-                recordingPathId = c['meta']['recordingPathId']
-                mod_cam_name = cameraName.replace(' ', '_').lower()
-                human_start_time = strftime('%d_%m_%Y-%H:%M:%S',  gmtime(startTime/1000.))
-                fullFileName = f"{human_start_time}-{mod_cam_name}.mp4"
-
-                self.dict_info_clip.update({clip_id: clip_info(clip_id, startTime, endTime, eventType, inProgress, locked, cameraName, recordingPathId, fullFileName)})
-                
+                continue
+            # Clips that are done recording
+            cameraName = c['meta']['cameraName']
+            human_start_time = datetime.fromtimestamp(c['startTime'] / 1000, timezone.utc).strftime('%d_%m_%Y-%H:%M:%S')
+            fullFileName = f"{human_start_time}-{_normalize_camera_name(cameraName)}.mp4"
+
+            self.dict_info_clip[c['_id']] = ClipInformation(clip_id=c['_id'], startTime=c['startTime'], endTime=c['endTime'],
+                                                            eventType=c['eventType'], inProgress=c['inProgress'], locked=c['locked'],
+                                                            cameraName=cameraName, recordingPathId=c['meta']['recordingPathId'],
+                                                            fullFileName=fullFileName)
+
     def camera_name(self, camera_name_list):
         """
         Function to parse out the camera's name from a given input
         """
-        camera_id_list = list()
-        for id in self.camera_info_dict:
-            if self.camera_info_dict[id].camera_name in camera_name_list:
-                # print(self.camera_info_dict[id].camera_id)
-                camera_id_list.append(self.camera_info_dict[id].camera_id)
-        if len(camera_id_list) is 0:
+        # dict.fromkeys drops names given more than once but keeps their order
+        camera_id_list = [cid for n in dict.fromkeys(camera_name_list) for cid in self.camera_name_dict.get(n, ())]
+        if len(camera_id_list) == 0:
             self.logger.error("Your camera name doesn't exist. Check the spelling and try again.")
             sys.exit(1)
         else:
@@ -207,8 +291,6 @@ class UVC_API_Async(object):
         sortBy = 'startTime'
         idsOnly = True
         sort = 'desc'
-        search_headers = {'content-type': 'application/x-www-form-urlencoded'}
-        # search_headers.update(self.session.headers)
 
         """
         /api/2.0/recording?
@@ -226,30 +308,25 @@ class UVC_API_Async(object):
         search_params = [('cause[]', 'fullTimeRecording'), ('startTime', epoch_start), ('endTime', epoch_end), ('idsOnly', str(idsOnly)), ('sortBy', sortBy), ('sort', sort)]
         
         # Append list of camera IDs
-        # If camera list is empty, don't do anything.
-        if len(camera_id_list) is 0:
-            pass
-        else:
-            for cam_id in camera_id_list:
-                search_params.append(('cameras[]', cam_id))
+        for cam_id in camera_id_list:
+            search_params.append(('cameras[]', cam_id))
 
         # Prepare the search data
-        async with self.session.request('GET', f"{self.url}/api/2.0/recording", params=search_params, headers=search_headers) as r:
-            if r.status is 200:
-                self.logger.info("Searching for clips")
-            elif r.status is 401:
+        async with self.session.request('GET', f"{self.url}/api/2.0/recording", params=search_params, headers=self._SEARCH_HEADERS) as r:
+            if r.status == 401:
                 self.logger.critical(f'Unauthorized, exiting.')
                 sys.exit(1)
-            else:
+            elif r.status != 200:
                 self.logger.critical(f'An error occured: {r.status}')
                 sys.exit(1)
+            self.logger.info("Searching for clips")
 
             # Get clip meta data
-            data = await r.json()
-        self.logger.info("Downloaded the meta data for each clip. ")
+            data = orjson.loads(await r.read())
         await self.clip_meta_data(data['data'])
+        self.logger.info("Downloaded the meta data for each clip. ")
 
-    async def download_footage(self, loop, max_connections, output_path= Path('downloaded_clips')):
+    async def download_footage(self, max_connections, output_path= Path('downloaded_clips')):
         """
         - Search for footage & get ID values
         - Try to get the sizes for each clip
@@ -257,44 +334,51 @@ class UVC_API_Async(object):
         - Name the clip and save it to disk in a folder for each camera
         """
         example = "/api/2.0/recording/5bb829e4b3a28701fe50b258/download"
-        meta_cookies = {'cameras.isManagedFilterOn': 'false'}
 
         # Create output if it doesn't exist yet
         self.outputPathCheck(output_path)
+        # Create each camera's folder once up front instead of checking per clip
+        camera_dirs = {_camera_dir(output_path, c.cameraName) for c in self.dict_info_clip.values()}
+        for camera_dir in camera_dirs:
+            camera_dir.mkdir(parents=True, exist_ok=True)
         # Build a generator with ClipInformation types
         clip_data_generator = (self.dict_info_clip[i] for i in self.dict_info_clip)
-        async with TaskPool(workers=max_connections, loop=loop) as tasks:
+        async with TaskPool(workers=max_connections) as tasks:
             for clip_information in clip_data_generator:
                 await tasks.put(self.fetch(clip_information, output_path))
             
     async def fetch(self, clip_info, output_path=Path('downloaded_clips')):
         # Actually grab the file
-        r = await self.session.request('GET', f"{self.url}/api/2.0/recording/{clip_info.clip_id}/download", cookies={'cameras.isManagedFilterOn': 'false'})
-        self.logger.debug(f'Sending request to download clip {clip_info.clip_id}')
+        async with self.session.request('GET', f"{self.url}/api/2.0/recording/{clip_info.clip_id}/download") as r:
+            self.logger.debug(f'Sending request to download clip {clip_info.clip_id}')
 
-        if r.status is 200:
+            if r.status == 401:
+                self.logger.critical(f'Unauthorized, exiting.')
+                sys.exit(1)
+            elif r.status != 200:
+                self.logger.critical(f'Unexpected error occured: {r.status}. Exiting.')
+                self.logger.critical(await r.text())
+                sys.exit(1)
             self.logger.debug(f'Successfully requested clip {clip_info.clip_id}. Status 200')
-        elif r.status is 401:
-            self.logger.critical(f'Unauthorized, exiting.')
-            sys.exit(1)
-        else:
-            self.logger.critical(f'Unexpected error occured: {r.status}. Exiting.')
-            self.logger.critical(r.text)
-            sys.exit(1)
 
-        total = r.headers.get('Content-Length')
-        num_chunks = round(int(total) / self.chunk_size)
-        file_path = Path(output_path, clip_info.cameraName.replace(' ', '_'), clip_info.fullFileName)
-        self.logger.info(f"Downloading file {clip_info.fullFileName} now.")
-        if not file_path.parent.exists():
-            file_path.parent.mkdir(exist_ok=True)
+            file_path = _camera_dir(output_path, clip_info.cameraName) / clip_info.fullFileName
+            self.logger.info(f"Downloading file {clip_info.fullFileName} now.")
 
-        with open(file_path, 'wb') as f:
-            async for data in r.content.iter_chunked(1024):
-                f.write(data)
+            # Write through aiofiles so disk I/O doesn't block the other downloads.
+            # Take whatever the socket hands us and flush to disk once chunk_size bytes are buffered.
+            async with aiofiles.open(file_path, 'wb') as f:
+                buf = list()
+                buf_len = 0
+                async for data in r.content.iter_any():
+                    buf.append(data)
+                    buf_len += len(data)
+                    if buf_len >= self.chunk_size:
+                        await f.write(b''.join(buf))
+                        buf.clear()
+                        buf_len = 0
+                if buf:
+                    await f.write(b''.join(buf))
         self.logger.info(f"Finished downloading file {clip_info.fullFileName}.")
-        
-        r.close()
 
     def outputPathCheck(self, output_path):
         """
@@ -315,10 +399,9 @@ class UVC_API_Async(object):
 
 class TaskPool(object):
     
-    def __init__(self, workers, loop):
+    def __init__(self, workers):
         self._tasks = set()
         self._closed = False
-        self._loop = asyncio.get_event_loop()
         self._semaphore = asyncio.Semaphore(workers)
     
     async def put(self, coro):
@@ -327,7 +410,7 @@ class TaskPool(object):
         
         await self._semaphore.acquire()
         
-        task = asyncio.ensure_future(coro, loop=self._loop)
+        task = asyncio.ensure_future(coro)
         self._tasks.add(task)
         task.add_done_callback(self._on_task_done)
     
@@ -336,11 +419,13 @@ class TaskPool(object):
         self._semaphore.release()
     
     async def join(self):
-        await asyncio.gather(*self._tasks, loop=self._loop)
+        # Snapshot the tasks, _on_task_done removes them from the set as they finish
         self._closed = True
+        tasks = list(self._tasks)
+        await asyncio.gather(*tasks)
     
     async def __aenter__(self):
         return self
     
-    def __aexit__(self, exc_type, exc, tb):
-        return self.join()
\ No newline at end of file
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.join()
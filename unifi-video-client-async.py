@@ -8,6 +8,12 @@ import aiomonitor
 import click
 import pendulum
 
+try:
+    import uvloop
+except ImportError:
+    # uvloop doesn't support Windows, use the default event loop there
+    uvloop = None
+
 from UVCAsyncLib.UVCAsyncLib import UVC_API_Async
 
 # Create base logger
@@ -15,7 +21,7 @@ logger = logging.getLogger("UVC-DVR-Downloader")
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
-async def sub_main(ctx, start_time, end_time, username, hostname, port, output_dir, password, camera_names, timezone, max_connections, dry_run, logger, debug, loop):
+async def sub_main(ctx, start_time, end_time, username, hostname, port, output_dir, password, camera_names, timezone, max_connections, async_dns, dry_run, logger, debug):
     """
     Main function but is asynchronous
     """
@@ -40,34 +46,37 @@ async def sub_main(ctx, start_time, end_time, username, hostname, port, output_d
     # Convert the datetime object to JavaScript Epoch time
     utc_end_epoch = utc_end.int_timestamp * 1000
     
-    client = UVC_API_Async(hostname, port, username, password, logger, sleep_time=0)  # , proxy=proxy)
-    
-    raw_resp = await client.login()
-    
-    raw_resp = await client.camera_info()
-    
-    camera_id_list = client.camera_name(camera_names)
-    
-    await client.clip_search(epoch_start=utc_start_epoch, epoch_end=utc_end_epoch, camera_id_list=camera_id_list)
+    client = UVC_API_Async(hostname, port, username, password, logger, max_connections=max_connections, async_dns=async_dns)  # , proxy=proxy)
     
-    if dry_run:
-        logger.critical("This is a DRY RUN. No videos were downloaded.")
-        logger.info(f"This query would have downloaded {len(client.dict_info_clip)} videos.")
-    else:
-        logger.debug("Not a dry run. All is normal.")
-        await client.download_footage(loop, max_connections, Path(output_dir))
-    
-    raw_resp = await client.logout()
-    await client.session.close()
+    # Close both HTTP clients on every exit path, sys.exit included
+    try:
+        raw_resp = await client.login()
+        
+        raw_resp = await client.camera_info()
+        
+        camera_id_list = client.camera_name(camera_names)
+        
+        await client.clip_search(epoch_start=utc_start_epoch, epoch_end=utc_end_epoch, camera_id_list=camera_id_list)
+        
+        if dry_run:
+            logger.critical("This is a DRY RUN. No videos were downloaded.")
+            logger.info(f"This query would have downloaded {len(client.dict_info_clip)} videos.")
+        else:
+            logger.debug("Not a dry run. All is normal.")
+            await client.download_footage(max_connections, Path(output_dir))
+        
+        raw_resp = await client.logout()
+    finally:
+        await client.close()
     
 def datetime_check(ctx, param, value):
     """
     Function to check the datetime input
     """
     if value is None:
-        if param.name is 'start_time':
+        if param.name == 'start_time':
             raise click.BadParameter('You must provide a start time.')
-        elif param.name is 'end_time':
+        elif param.name == 'end_time':
             raise click.BadParameter('You must provide an end time.')
         else:
             raise click.BadParameter(f'I\'m being called for {param.name} which is wrong.')
@@ -76,9 +85,9 @@ def datetime_check(ctx, param, value):
         denver_dt = pendulum.from_format(value, 'DD-MM-YYYY:HH:mm:ss')
         return value
     except:
-        if param.name is 'start_time':
+        if param.name == 'start_time':
             raise click.BadParameter('Start datetime is not in the correct format.')
-        elif param.name is 'end_time':
+        elif param.name == 'end_time':
             raise click.BadParameter('End datetime is not in the correct format.')
         else:
             raise click.BadParameter(f'I\'m being called for {param.name} which is wrong.')
@@ -113,13 +122,14 @@ def timezone_check(ctx, param, value):
 @click.option('--password', help='UVC User\'s password. Script will prompt for password later on if not entered. This option exists for scripting.', prompt=True, hide_input=True)
 @click.option('-tz', '--timezone', callback=timezone_check, help='Set timezone to be something other than \'America/Denver\'. Default is \'America/Denver\'.', default='America/Denver', type=click.STRING)
 @click.option('-m', '--max-connections', help='Maximum connections to have open at once downloading files. Default is 4.', type=click.IntRange(1, 1000), default=4)
+@click.option('--async-dns', help="Resolve the Video controller's hostname with aiodns instead of the system resolver. Can't resolve mDNS (.local) names.", default=False, is_flag=True)
 @click.option('--debug', help="Show debug logs and start AIOMonitor. ", default=False, is_flag=True)
 @click.option('-v', '--verbose', help="Show more information than normal. ", default=False, is_flag=True)
 @click.option('-q', '--quiet', help="Show less information than normal. ", default=False, is_flag=True)
 @click.option('-n','--dry-run', help="Don't download videos, just get a list that *would* be downloaded.", default=False, is_flag=True)
 @click.argument('camera-names', nargs=-1)
 @click.pass_context
-def main(ctx, start_time, end_time, username, hostname, port, output_dir, password, camera_names, timezone, max_connections, dry_run, debug, verbose, quiet):
+def main(ctx, start_time, end_time, username, hostname, port, output_dir, password, camera_names, timezone, max_connections, async_dns, dry_run, debug, verbose, quiet):
     """Download videos for cameras for a specific time frame.
 
     Times default to America/Denver."""
@@ -150,14 +160,15 @@ def main(ctx, start_time, end_time, username, hostname, port, output_dir, passwo
     # Add console handler to main logger
     logger.addHandler(ch)
     
-    # Drop into an event loop
-    loop = asyncio.get_event_loop()
+    # Drop into an event loop, backed by libuv when uvloop is installed
+    loop = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     if debug:
         logger.debug("Debug mode enabled. Use Netcat or Telnet to connect to 127.0.0.1 port 50101 for AIO internal information. This uses the library 'aiomonitor'.")
         with aiomonitor.start_monitor(loop=loop):
-            loop.run_until_complete(sub_main(ctx, start_time, end_time, username, hostname, port, output_dir, password, camera_names, timezone, max_connections, dry_run, logger, debug, loop))
+            loop.run_until_complete(sub_main(ctx, start_time, end_time, username, hostname, port, output_dir, password, camera_names, timezone, max_connections, async_dns, dry_run, logger, debug))
     else:
-        loop.run_until_complete(sub_main(ctx, start_time, end_time, username, hostname, port, output_dir, password, camera_names, timezone, max_connections, dry_run, logger, debug, loop))
+        loop.run_until_complete(sub_main(ctx, start_time, end_time, username, hostname, port, output_dir, password, camera_names, timezone, max_connections, async_dns, dry_run, logger, debug))
 
 if __name__ == "__main__":
     main()